@@ -1,27 +1,87 @@
+import asyncio
+import atexit
+import hashlib
 import logging
+import mimetypes
 import os
+import queue
+import random
 import time
-from typing import Any, Dict
+from collections import deque
+from contextlib import asynccontextmanager
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict, List, Optional, Tuple
 
-from fastapi import FastAPI, HTTPException
+import httpx
+import orjson
+from cachetools import TTLCache
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from pydantic import BaseModel
-import requests
-from requests.exceptions import ReadTimeout, RequestException
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
 
 # --- App setup ---
-app = FastAPI(title="Jarvis Chat Proxy")
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # OK for dev; restrict in production
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# One pooled client per upstream host, shared across requests so warm calls
+# reuse keep-alive / HTTP/2 connections instead of re-handshaking every time.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if not HF_TOKEN:
+        logger.warning("HF_TOKEN not set. Primary may fail for private models.")
+    app.state.hf_client = httpx.AsyncClient(
+        base_url="https://api-inference.huggingface.co",
+        timeout=httpx.Timeout(60.0, connect=10.0),
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        http2=True,
+    )
+    app.state.colab_client = httpx.AsyncClient(
+        timeout=httpx.Timeout(120.0, connect=10.0),
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+    )
+    if CACHE_EMBED_MODEL and response_cache.mode != "disabled":
+        await asyncio.to_thread(response_cache.load_embedder, CACHE_EMBED_MODEL)
+    batcher_task = asyncio.create_task(primary_batcher.run())
+    yield
+    batcher_task.cancel()
+    await app.state.colab_client.aclose()
+    await app.state.hf_client.aclose()
+
+class ORJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
 
-logging.basicConfig(level=logging.INFO)
+app = FastAPI(title="Jarvis Chat Proxy", lifespan=lifespan, default_response_class=ORJSONResponse)
+# Cross-origin callers, comma-separated (e.g. https://example.com). The bundled
+# page is same-origin, so with none configured CORS handling is skipped entirely.
+ALLOWED_ORIGINS = [o.strip() for o in os.getenv("ALLOWED_ORIGINS", "").split(",") if o.strip()]
+if ALLOWED_ORIGINS:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=ALLOWED_ORIGINS,
+        allow_methods=["GET", "POST"],
+        allow_headers=["content-type", "x-api-key"],
+        max_age=86400,
+    )
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=5)
+
+# Only the stderr write is offloaded: QueueHandler.prepare() still merges the
+# message args (and formats any traceback) on the event loop before enqueueing;
+# the listener thread adds the level/name prefix and does the blocking write.
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+log_listener = QueueListener(_log_queue, _log_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))  # prefix added by listener
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), handlers=[_queue_handler])
+logging.getLogger("httpx").setLevel(logging.WARNING)  # one INFO line per upstream request otherwise
 logger = logging.getLogger("jarvis")
 
 # --- Config (set these in environment) ---
@@ -31,23 +91,182 @@ FALLBACK_REPO = os.getenv("HF_FALLBACK", "gpt2")
 PRIMARY_TIMEOUT = int(os.getenv("HF_PRIMARY_TIMEOUT", "180"))
 FALLBACK_TIMEOUT = int(os.getenv("HF_FALLBACK_TIMEOUT", "60"))
 PRIMARY_RETRIES = int(os.getenv("HF_PRIMARY_RETRIES", "2"))
+BACKOFF_BASE = float(os.getenv("HF_BACKOFF_BASE", "1"))
+BACKOFF_CAP = float(os.getenv("HF_BACKOFF_CAP", "8"))
+BREAKER_THRESHOLD = int(os.getenv("HF_BREAKER_THRESHOLD", "5"))  # consecutive primary failures
+BREAKER_COOLDOWN = float(os.getenv("HF_BREAKER_COOLDOWN", "30"))
+MAX_BATCH = int(os.getenv("HF_MAX_BATCH", "16"))
+BATCH_WINDOW = float(os.getenv("HF_BATCH_WINDOW_MS", "20")) / 1000
+BATCH_BUCKETS = (128, 512, 2048)  # prompt length (tokens) upper bounds per batch bucket
+MAX_INPUT_TOKENS = int(os.getenv("MAX_INPUT_TOKENS", "2048"))  # 0 = no cap
 
 # Colab proxy config (for Colab/ngrok)
 COLAB_URL = os.getenv("COLAB_URL")        # e.g. https://xxxx.ngrok.io
 COLAB_API_KEY = os.getenv("COLAB_API_KEY")  # shared secret (must match Colab)
 
-HEADERS = {"Authorization": f"Bearer {HF_TOKEN}"} if HF_TOKEN else {}
+HEADERS = {"Content-Type": "application/json"}
+if HF_TOKEN:
+    HEADERS["Authorization"] = f"Bearer {HF_TOKEN}"
+# relative to the HF client's base_url
+MODEL_PATHS = {repo: f"/models/{repo}" for repo in (PRIMARY_REPO, FALLBACK_REPO)}
+# Top-level payload fields sent alongside "inputs" on every primary call; fixed,
+# so the cache scope is too. Generation settings would go under a nested
+# "parameters" key here, which is where estimate_tokens() looks for max_new_tokens.
+PRIMARY_OPTIONS: Dict[str, Any] = {"options": {"wait_for_model": True}}
+
+# Outbound HF rate limits for this token (0 = unlimited)
+HF_RPM = int(os.getenv("HF_RPM", "0"))
+HF_TPM = int(os.getenv("HF_TPM", "0"))
+HF_EST_NEW_TOKENS = int(os.getenv("HF_EST_NEW_TOKENS", "64"))  # assumed completion size when unspecified
+
+# Response cache config
+CACHE_MODE = os.getenv("CACHE_MODE", "enabled")  # enabled | read-only | replay | disabled
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAXSIZE", "10000"))
+CACHE_TTL = int(os.getenv("CACHE_TTL", "3600"))
+# Optional semantic (L2) tier: needs sentence-transformers installed, e.g.
+# CACHE_EMBED_MODEL=sentence-transformers/all-MiniLM-L6-v2
+CACHE_EMBED_MODEL = os.getenv("CACHE_EMBED_MODEL")
+CACHE_SEMANTIC_SIZE = int(os.getenv("CACHE_SEMANTIC_SIZE", "1000"))
+CACHE_SEMANTIC_THRESHOLD = float(os.getenv("CACHE_SEMANTIC_THRESHOLD", "0.95"))
 
 # --- Request schema ---
 class Req(BaseModel):
     prompt: str
 
+# --- Response cache: L1 exact match, optional L2 embedding similarity ---
+def cache_key(repo: str, extra: Dict[str, Any], prompt: str) -> str:
+    raw = b"|".join((repo.encode(), orjson.dumps(extra, option=orjson.OPT_SORT_KEYS), prompt.encode()))
+    return hashlib.sha256(raw).hexdigest()
+
+class ResponseCache:
+    def __init__(self, mode: str, maxsize: int, ttl: int, semantic_size: int, threshold: float):
+        if mode not in ("enabled", "read-only", "replay", "disabled"):
+            raise ValueError(f"Unknown CACHE_MODE: {mode}")
+        self.mode = mode
+        self.threshold = threshold
+        self.ttl = ttl
+        self._exact: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # (scope, embedding, value, expires_at); same TTL as the exact tier
+        self._semantic: deque = deque(maxlen=semantic_size)
+        self._lock = asyncio.Lock()
+        self._embedder = None
+
+    def load_embedder(self, model_name: str) -> None:
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            logger.warning("CACHE_EMBED_MODEL set but sentence-transformers is not installed; semantic cache off")
+            return
+        self._embedder = SentenceTransformer(model_name)
+        logger.info("Semantic cache enabled with %s", model_name)
+
+    async def _embed(self, prompt: str):
+        return await asyncio.to_thread(self._embedder.encode, prompt, normalize_embeddings=True)
+
+    async def get(self, key: str, scope: str, prompt: str) -> Tuple[Optional[Dict[str, Any]], Any]:
+        """Return (cached value or None, prompt embedding or None). Pass the
+        embedding back to put() on a miss so the prompt isn't encoded twice."""
+        if self.mode == "disabled":
+            return None, None
+        async with self._lock:
+            hit = self._exact.get(key)
+        if hit is not None or self._embedder is None:
+            return hit, None
+        vec = await self._embed(prompt)
+        now = time.monotonic()
+        best, best_sim = None, self.threshold
+        for entry_scope, emb, value, expires_at in list(self._semantic):
+            if entry_scope != scope or expires_at <= now:
+                continue
+            sim = float(emb @ vec)
+            if sim > best_sim:
+                best, best_sim = value, sim
+        return best, vec
+
+    async def put(self, key: str, scope: str, prompt: str, value: Dict[str, Any],
+                  embedding: Any = None) -> None:
+        if self.mode != "enabled":
+            return
+        async with self._lock:
+            self._exact[key] = value
+        if self._embedder is not None:
+            if embedding is None:
+                embedding = await self._embed(prompt)
+            self._semantic.append((scope, embedding, value, time.monotonic() + self.ttl))
+
+response_cache = ResponseCache(
+    CACHE_MODE, CACHE_MAXSIZE, CACHE_TTL, CACHE_SEMANTIC_SIZE, CACHE_SEMANTIC_THRESHOLD
+)
+
+# --- Prompt size: token counting and ingress cap ---
+# Token counts are estimated as ~4 chars/token. HF models each have their own
+# tokenizer anyway, and this is O(1), so it is close enough for the size cap,
+# batch bucketing and rate-limit estimates without tokenizing on the event loop.
+def count_tokens(text: str) -> int:
+    return len(text) // 4
+
+def check_prompt_size(prompt: str) -> None:
+    if MAX_INPUT_TOKENS and count_tokens(prompt) > MAX_INPUT_TOKENS:
+        raise HTTPException(status_code=413, detail=f"Prompt exceeds {MAX_INPUT_TOKENS} tokens (~4 chars each)")
+
+# --- Token bucket: keep outbound RPM/TPM under the HF quota ---
+class TokenBucket:
+    """Two buckets refilled continuously at rpm/60 requests and tpm/60
+    tokens per second. acquire() waits (FIFO, via the lock) until one
+    request and `estimated_tokens` tokens are available."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.request_tokens = float(rpm)
+        self.token_tokens = float(tpm)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, estimated_tokens: int) -> None:
+        # a request bigger than the whole bucket would otherwise never fit
+        need = min(estimated_tokens, self.tpm) if self.tpm else 0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                elapsed, self.updated = now - self.updated, now
+                if self.rpm:
+                    self.request_tokens = min(self.rpm, self.request_tokens + elapsed * self.rpm / 60)
+                if self.tpm:
+                    self.token_tokens = min(self.tpm, self.token_tokens + elapsed * self.tpm / 60)
+                req_short = 1 - self.request_tokens if self.rpm else 0
+                tok_short = need - self.token_tokens if self.tpm else 0
+                if req_short <= 0 and tok_short <= 0:
+                    break
+                await asyncio.sleep(max(
+                    req_short * 60 / self.rpm if req_short > 0 else 0,
+                    tok_short * 60 / self.tpm if tok_short > 0 else 0,
+                ))
+            if self.rpm:
+                self.request_tokens -= 1
+            if self.tpm:
+                self.token_tokens -= need
+
+hf_bucket = TokenBucket(HF_RPM, HF_TPM) if (HF_RPM or HF_TPM) else None
+
+def estimate_tokens(payload: Dict[str, Any]) -> int:
+    inputs = payload["inputs"]
+    prompts = inputs if isinstance(inputs, list) else [inputs]
+    new_tokens = payload.get("parameters", {}).get("max_new_tokens", HF_EST_NEW_TOKENS)
+    return sum(count_tokens(p) + new_tokens for p in prompts)
+
 # --- Helper to call HF inference ---
-def hf_post(repo: str, payload: Dict[str, Any], timeout: int) -> requests.Response:
-    url = f"https://api-inference.huggingface.co/models/{repo}"
-    logger.info("Calling HF repo=%s timeout=%ds", repo, timeout)
-    resp = requests.post(url, headers=HEADERS, json=payload, timeout=timeout)
-    logger.info("HF response: repo=%s status=%s", repo, resp.status_code)
+async def hf_post(repo: str, payload: Dict[str, Any], timeout: int) -> httpx.Response:
+    if hf_bucket:
+        await hf_bucket.acquire(estimate_tokens(payload))
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        logger.debug("Calling HF repo=%s timeout=%ds", repo, timeout)
+    resp = await app.state.hf_client.post(
+        MODEL_PATHS[repo], headers=HEADERS, content=orjson.dumps(payload), timeout=timeout
+    )
+    if debug:
+        logger.debug("HF response: repo=%s status=%s", repo, resp.status_code)
     return resp
 
 def normalize_output(resp_json: Any) -> str:
@@ -57,40 +276,272 @@ def normalize_output(resp_json: Any) -> str:
         return resp_json["generated_text"]
     return str(resp_json)
 
+def parse_body(resp: httpx.Response) -> Any:
+    try:
+        return orjson.loads(resp.content)
+    except ValueError:
+        return resp.text
+
+# --- Circuit breaker: stop hammering the primary while it is down ---
+class CircuitBreaker:
+    """closed -> open after `threshold` consecutive failed upstream calls;
+    once `cooldown` seconds have passed, half_open lets a single probe
+    through while everyone else keeps going to the fallback. Any success
+    closes it, a failed probe re-opens it."""
+
+    def __init__(self, name: str, threshold: int, cooldown: float):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failure_count = 0
+        self.state = "closed"
+        self.opened_at = 0.0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.cooldown:
+            return False
+        # cooldown over, or the last probe never reported back: admit one probe
+        self.state = "half_open"
+        self.opened_at = now
+        return True
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logger.info("Circuit %s closed", self.name)
+        self.failure_count = 0
+        self.state = "closed"
+
+    def record_failure(self) -> None:
+        self.failure_count += 1
+        if self.state == "half_open" or self.failure_count >= self.threshold:
+            if self.state != "open":
+                logger.warning("Circuit %s open after %d failures", self.name, self.failure_count)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+primary_breaker = CircuitBreaker(PRIMARY_REPO, BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+
+# --- Micro-batching: coalesce concurrent prompts into one HF call ---
+class HFBatcher:
+    """Collects prompts for `repo` for up to `window` seconds (or `max_batch`
+    items) and sends them as a single list-input request. submit() resolves
+    to (status_code, body) for that prompt, or raises the httpx error.
+    Each upstream HTTP call is reported to `breaker` once, however many
+    prompts it carried.
+
+    Pending prompts are split into length buckets so a batch never mixes a
+    one-line FAQ with an essay (the short ones would be padded to the long
+    one's length); the fullest bucket is drained first."""
+
+    def __init__(self, repo: str, max_batch: int, window: float, timeout: int,
+                 bucket_bounds: Tuple[int, ...] = BATCH_BUCKETS,
+                 breaker: Optional[CircuitBreaker] = None):
+        self.repo = repo
+        self.breaker = breaker
+        self.max_batch = max_batch
+        self.window = window
+        self.timeout = timeout
+        self.single_mode = max_batch <= 1  # flipped if the model rejects list inputs
+        self.bucket_bounds = bucket_bounds
+        self._buckets: List[deque] = [deque() for _ in range(len(bucket_bounds) + 1)]
+        self._ready = asyncio.Event()
+        self._tasks: set = set()
+
+    def _record(self, ok: bool) -> None:
+        if self.breaker is None:
+            return
+        if ok:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    def _bucket_for(self, prompt: str) -> deque:
+        n = count_tokens(prompt)
+        for i, bound in enumerate(self.bucket_bounds):
+            if n < bound:
+                return self._buckets[i]
+        return self._buckets[-1]
+
+    async def submit(self, prompt: str, extra: Dict[str, Any]) -> Tuple[int, Any]:
+        fut = asyncio.get_running_loop().create_future()
+        self._bucket_for(prompt).append((prompt, extra, fut))
+        self._ready.set()
+        # hf_post's own timeout normally fires first; this only stops a caller
+        # waiting forever on a future the dispatcher never resolved
+        return await asyncio.wait_for(fut, self.timeout + 5)
+
+    async def _wait_window(self) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.window
+        while max(map(len, self._buckets)) < self.max_batch:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+
+    async def run(self) -> None:
+        while True:
+            if not any(self._buckets):
+                self._ready.clear()
+                await self._ready.wait()
+                if not self.single_mode:  # nothing to coalesce once list input is off
+                    await self._wait_window()
+            # leftovers from other buckets already waited a window; drain them next round
+            fullest = max(self._buckets, key=len)
+            batch = [fullest.popleft() for _ in range(min(len(fullest), self.max_batch))]
+            groups: Dict[bytes, List] = {}
+            for item in batch:
+                groups.setdefault(orjson.dumps(item[1], option=orjson.OPT_SORT_KEYS), []).append(item)
+            for group in groups.values():
+                task = asyncio.create_task(self._dispatch(group))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, group: List) -> None:
+        group = [item for item in group if not item[2].done()]  # drop callers that gave up
+        if not group:
+            return
+        try:
+            await self._send_group(group)
+        except Exception as e:
+            logger.exception("Dispatch to %s failed", self.repo)
+            for _, _, fut in group:
+                if not fut.done():
+                    fut.set_exception(e)
+
+    async def _send_group(self, group: List) -> None:
+        if self.single_mode or len(group) == 1:
+            await asyncio.gather(*(self._send_one(item) for item in group))
+            return
+        extra = group[0][1]
+        payload = {"inputs": [prompt for prompt, _, _ in group], **extra}
+        try:
+            resp = await hf_post(self.repo, payload, timeout=self.timeout)
+        except httpx.HTTPError as e:
+            self._record(False)
+            for _, _, fut in group:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        body = parse_body(resp)
+        if resp.status_code == 200 and isinstance(body, list) and len(body) == len(group):
+            self._record(True)
+            for (_, _, fut), item in zip(group, body):
+                if not fut.done():
+                    fut.set_result((200, item))
+            return
+        if resp.status_code in (200, 400, 422):
+            # the rejection may be about one prompt (e.g. too long) rather than
+            # list input itself; only give up on batching if each prompt works alone
+            sent = await asyncio.gather(*(self._send_one(item) for item in group))
+            if all(sent):
+                logger.warning("Repo %s rejected list input (status=%s); switching to single-item mode",
+                               self.repo, resp.status_code)
+                self.single_mode = True
+            return
+        self._record(False)
+        for _, _, fut in group:
+            if not fut.done():
+                fut.set_result((resp.status_code, body))
+
+    async def _send_one(self, item) -> bool:
+        """Send one prompt on its own; True if HF answered 200."""
+        prompt, extra, fut = item
+        try:
+            resp = await hf_post(self.repo, {"inputs": prompt, **extra}, timeout=self.timeout)
+            result = (resp.status_code, parse_body(resp))
+        except httpx.HTTPError as e:
+            self._record(False)
+            if not fut.done():
+                fut.set_exception(e)
+            return False
+        except Exception as e:
+            logger.exception("Call to %s failed", self.repo)
+            if not fut.done():
+                fut.set_exception(e)
+            return False
+        self._record(resp.status_code == 200)
+        if not fut.done():
+            fut.set_result(result)
+        return resp.status_code == 200
+
+primary_batcher = HFBatcher(PRIMARY_REPO, MAX_BATCH, BATCH_WINDOW, PRIMARY_TIMEOUT, breaker=primary_breaker)
+
 # --- /generate endpoint: tries HF primary then fallback ---
+# Single-flight: one inference task per cache key; identical concurrent
+# prompts await the same task instead of each calling HF.
+in_flight: Dict[str, asyncio.Task] = {}
+PRIMARY_SCOPE = f"{PRIMARY_REPO}|{orjson.dumps(PRIMARY_OPTIONS, option=orjson.OPT_SORT_KEYS).decode()}"
+
 @app.post("/generate")
-def generate(payload: Req):
-    if not HF_TOKEN:
-        logger.warning("HF_TOKEN not set. Primary may fail for private models.")
-    data = {"inputs": payload.prompt, "options": {"wait_for_model": True}}
+async def generate(payload: Req):
+    check_prompt_size(payload.prompt)
+    key = cache_key(PRIMARY_REPO, PRIMARY_OPTIONS, payload.prompt)
+    cached, embedding = await response_cache.get(key, PRIMARY_SCOPE, payload.prompt)
+    if cached is not None:
+        return {**cached, "cached": True}
+    if response_cache.mode == "replay":
+        raise HTTPException(status_code=404, detail="No cached response (CACHE_MODE=replay)")
+
+    # no await between lookup and insert, so this needs no lock
+    task = in_flight.get(key)
+    if task is None:
+        task = asyncio.create_task(run_inference(
+            payload.prompt, PRIMARY_OPTIONS, key, PRIMARY_SCOPE, embedding
+        ))
+        in_flight[key] = task
+        task.add_done_callback(lambda _: in_flight.pop(key, None))
+    # shield: a disconnecting caller must not cancel the call other callers share
+    return await asyncio.shield(task)
 
+async def run_inference(prompt: str, extra: Dict[str, Any], key: str, scope: str,
+                        embedding: Any = None) -> Dict[str, Any]:
     last_exception = None
     for attempt in range(1, PRIMARY_RETRIES + 1):
+        if not primary_breaker.allow():
+            logger.warning("Circuit %s open; skipping to fallback", PRIMARY_REPO)
+            break
         try:
-            resp = hf_post(PRIMARY_REPO, data, timeout=PRIMARY_TIMEOUT)
-            if resp.status_code in (401, 403, 404):
-                logger.warning("Primary returned auth/slug error: %s", resp.status_code)
-                break
-            if resp.status_code == 200:
-                try:
-                    out = normalize_output(resp.json())
-                except Exception:
-                    out = str(resp.text)
-                return {"result": out, "model": PRIMARY_REPO}
-            logger.warning("Primary attempt %d returned status %s", attempt, resp.status_code)
-        except ReadTimeout as e:
+            status, body = await primary_batcher.submit(prompt, extra)
+        except (httpx.TimeoutException, asyncio.TimeoutError) as e:
             last_exception = e
             logger.warning("Primary attempt %d timed out (timeout=%ds)", attempt, PRIMARY_TIMEOUT)
-        except RequestException as e:
+        except httpx.RequestError as e:
             last_exception = e
             logger.exception("Primary attempt %d network error", attempt)
-        time.sleep(1 * (2 ** (attempt - 1)))
+        except Exception as e:
+            last_exception = e
+            logger.exception("Primary attempt %d failed", attempt)
+        else:
+            if status in (401, 403, 404):
+                logger.warning("Primary returned auth/slug error: %s", status)
+                break
+            if status == 200:
+                result = {"result": normalize_output(body), "model": PRIMARY_REPO}
+                # only primary answers are cached; a fallback answer shouldn't stick for CACHE_TTL
+                try:
+                    await response_cache.put(key, scope, prompt, result, embedding)
+                except Exception:
+                    # the answer is already in hand; a cache problem must not cost another HF call
+                    logger.exception("Response cache write failed")
+                return result
+            logger.warning("Primary attempt %d returned status %s", attempt, status)
+        if attempt < PRIMARY_RETRIES:
+            # full jitter keeps retries from many callers from arriving in lockstep
+            await asyncio.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (attempt - 1))))
 
     # fallback
     try:
-        resp_fb = hf_post(FALLBACK_REPO, data, timeout=FALLBACK_TIMEOUT)
+        resp_fb = await hf_post(FALLBACK_REPO, {"inputs": prompt, **extra}, timeout=FALLBACK_TIMEOUT)
         resp_fb.raise_for_status()
-        out_fb = normalize_output(resp_fb.json())
+        out_fb = normalize_output(orjson.loads(resp_fb.content))
         return {"result": out_fb, "model": FALLBACK_REPO, "note": "Served by fallback model"}
     except Exception as e:
         logger.exception("Fallback call failed")
@@ -99,27 +550,84 @@ def generate(payload: Req):
             detail_msg += f" Primary last error: {type(last_exception).__name__}"
         raise HTTPException(status_code=502, detail=detail_msg)
 
+# --- /generate-stream: relay primary model tokens as Server-Sent Events ---
+def sse_event(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {orjson.dumps(data).decode()}\n\n"
+
+# POST (the prompt is a JSON body), so browsers can't use EventSource here: read
+# it with fetch() and response.body.getReader(), splitting events on blank lines.
+@app.post("/generate-stream")
+async def generate_stream(payload: Req):
+    check_prompt_size(payload.prompt)
+    data = {"inputs": payload.prompt, "stream": True, **PRIMARY_OPTIONS}
+
+    async def events():
+        try:
+            if hf_bucket:
+                await hf_bucket.acquire(estimate_tokens(data))
+            async with app.state.hf_client.stream(
+                "POST", MODEL_PATHS[PRIMARY_REPO], headers=HEADERS, content=orjson.dumps(data),
+                timeout=PRIMARY_TIMEOUT,
+            ) as r:
+                if r.status_code != 200:
+                    await r.aread()
+                    logger.warning("Primary stream returned status %s", r.status_code)
+                    yield sse_event({"status": r.status_code, "detail": r.text[:500]}, event="error")
+                    return
+                async for line in r.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    raw = line[5:].strip()
+                    if raw == "[DONE]":
+                        break
+                    try:
+                        chunk = orjson.loads(raw)
+                    except ValueError:
+                        chunk = None
+                    if not isinstance(chunk, dict):
+                        logger.warning("Unparseable stream line from primary: %.200s", raw)
+                        yield sse_event({"detail": "Malformed upstream stream"}, event="error")
+                        return
+                    if "error" in chunk:
+                        yield sse_event({"detail": chunk["error"]}, event="error")
+                        return
+                    token = chunk.get("token") or {}
+                    if token.get("special"):
+                        continue
+                    yield sse_event({"token": token.get("text", "")})
+        except httpx.HTTPError as e:
+            logger.exception("Primary stream failed")
+            yield sse_event({"detail": type(e).__name__}, event="error")
+            return
+        yield sse_event({"model": PRIMARY_REPO}, event="done")
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+
 # --- /chat-to-colab: proxy to Colab/ngrok (server keeps secret) ---
 @app.post("/chat-to-colab")
-def chat_to_colab(payload: Req):
+async def chat_to_colab(payload: Req):
     if not COLAB_URL or not COLAB_API_KEY:
         logger.error("COLAB_URL or COLAB_API_KEY not configured on server")
         raise HTTPException(status_code=500, detail="COLAB_URL or COLAB_API_KEY not configured on server")
 
+    check_prompt_size(payload.prompt)
     forward_payload = {"prompt": payload.prompt}
     try:
-        r = requests.post(
+        r = await app.state.colab_client.post(
             f"{COLAB_URL.rstrip('/')}/generate",
             headers={
                 "Content-Type": "application/json",
                 "x-api-key": COLAB_API_KEY
             },
             json=forward_payload,
-            timeout=120
         )
         r.raise_for_status()
-        return r.json()
-    except requests.exceptions.RequestException:
+        return orjson.loads(r.content)
+    # ValueError: a 200 with a non-JSON body (e.g. an ngrok error page)
+    except (httpx.HTTPStatusError, httpx.RequestError, ValueError):
         logger.exception("Error calling Colab endpoint")
         raise HTTPException(status_code=502, detail="Upstream Colab inference failed")
 
@@ -128,18 +636,98 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 static_dir = os.path.join(BASE_DIR, "static")
 templates_dir = os.path.join(BASE_DIR, "templates")
 
-# mount /static if folder exists
-if os.path.isdir(static_dir):
-    app.mount("/static", StaticFiles(directory=static_dir), name="static")
+# When nginx/a CDN serves /static, set SERVE_STATIC=0 and (for a CDN on another
+# host) STATIC_URL=https://cdn.example.com/static so index.html points there.
+# Scripts build asset URLs from index.html's <meta name="static-url">, which is
+# rewritten along with the links; keep other asset paths out of JS/CSS.
+SERVE_STATIC = os.getenv("SERVE_STATIC", "1") != "0"
+STATIC_URL = os.getenv("STATIC_URL", "/static").rstrip("/")
+# assets aren't fingerprinted, so browsers revalidate (ETag) after max-age
+STATIC_CACHE_CONTROL = f"public, max-age={int(os.getenv('STATIC_MAX_AGE', '86400'))}"
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that serves a `.br` / `.gz` file sitting next to the
+    requested asset when the client accepts that encoding, so assets are
+    compressed once at build time rather than on every request."""
+
+    ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+    def __init__(self, *, directory: str, **kwargs):
+        super().__init__(directory=directory, **kwargs)
+        # scan once; assets don't change while the process is running
+        self._compressed = {
+            os.path.realpath(os.path.join(root, name))
+            for root, _, files in os.walk(directory)
+            for name in files
+            if name.endswith((".br", ".gz"))
+        }
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        accept = request_headers.get("accept-encoding", "")
+        for encoding, ext in self.ENCODINGS:
+            compressed = f"{full_path}{ext}"
+            if encoding in accept and compressed in self._compressed:
+                try:
+                    compressed_stat = os.stat(compressed)
+                except OSError:
+                    continue
+                # stat_result up front so ETag/Last-Modified exist for is_not_modified
+                response = FileResponse(
+                    compressed,
+                    status_code=status_code,
+                    stat_result=compressed_stat,
+                    media_type=mimetypes.guess_type(str(full_path))[0] or "application/octet-stream",
+                    headers={
+                        "Content-Encoding": encoding,
+                        "Vary": "Accept-Encoding",
+                        "Cache-Control": STATIC_CACHE_CONTROL,
+                    },
+                )
+                if self.is_not_modified(response.headers, request_headers):
+                    return NotModifiedResponse(response.headers)
+                return response
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        response.headers["Cache-Control"] = STATIC_CACHE_CONTROL
+        return response
+
+# mount /static if folder exists (and nothing in front is serving it)
+if SERVE_STATIC and os.path.isdir(static_dir):
+    app.mount("/static", PrecompressedStaticFiles(directory=static_dir), name="static")
+
+# index.html is static: locate and read it once at import, serve from memory
+def _load_index() -> Optional[bytes]:
+    for path in (os.path.join(templates_dir, "index.html"), os.path.join(BASE_DIR, "index.html")):
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                html = f.read()
+            if STATIC_URL != "/static":
+                html = html.replace(b'"/static/', f'"{STATIC_URL}/'.encode())
+            return html
+    return None
+
+INDEX_BYTES = _load_index()
+INDEX_ETAG = f'"{hashlib.md5(INDEX_BYTES).hexdigest()}"' if INDEX_BYTES is not None else None
+INDEX_HEADERS = {"ETag": INDEX_ETAG, "Cache-Control": "public, max-age=300"} if INDEX_ETAG else {}
 
-# serve index.html if exists in templates/
 @app.get("/")
-def home():
-    idx = os.path.join(templates_dir, "index.html")
-    if os.path.isfile(idx):
-        return FileResponse(idx)
-    # fallback: if index in base dir
-    idx2 = os.path.join(BASE_DIR, "index.html")
-    if os.path.isfile(idx2):
-        return FileResponse(idx2)
-    raise HTTPException(status_code=404, detail="Index not found")
+async def home(request: Request):
+    if INDEX_BYTES is None:
+        raise HTTPException(status_code=404, detail="Index not found")
+    if INDEX_ETAG in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=INDEX_HEADERS)
+    return Response(INDEX_BYTES, media_type="text/html", headers=INDEX_HEADERS)
+
+# --- local entrypoint (Render uses the startCommand in render.yaml) ---
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        # caches, batcher and rate limiter are per process; scale out deliberately
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        # loop/http stay on "auto": uvloop + httptools when installed (not on Windows)
+        access_log=False,
+    )
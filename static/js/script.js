@@ -1,12 +1,16 @@
 
 
+// Asset base from <meta name="static-url"> (points at the CDN when one is configured)
+const STATIC_BASE =
+  document.querySelector('meta[name="static-url"]')?.content || "/static/";
+
 // ----- CONTENT (AI Engineer) -----
 const CONTENT = {
   name: "Ahmed Shaikh",
   role: "AI Engineer • LLMs & Computer Vision • MLOps",
   bio:
     "I design, train, and ship AI systems—LLMs, agents, and vision models—optimized for real-world latency, accuracy, and cost. I turn research into reliable products with clean APIs, strong guardrails, and rigorous evaluation.",
-  photo: "/static/images/photo.jpg",
+  photo: STATIC_BASE + "images/photo.jpg",
 
 
   skills: [
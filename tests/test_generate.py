@@ -0,0 +1,340 @@
+import asyncio
+import time
+
+import httpx
+import orjson
+import pytest
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(main.response_cache, "mode", "disabled")
+    monkeypatch.setattr(main, "BACKOFF_BASE", 0)
+    # asyncio primitives bind to the first loop that uses them; each test runs its own loop
+    monkeypatch.setattr(main, "primary_batcher", main.HFBatcher(
+        main.PRIMARY_REPO, main.MAX_BATCH, main.BATCH_WINDOW, main.PRIMARY_TIMEOUT,
+        breaker=main.primary_breaker,
+    ))
+    main.primary_breaker.record_success()
+    main.in_flight.clear()
+
+
+def run_with_hf(handler, coro_fn):
+    async def runner():
+        async with main.lifespan(main.app):
+            await main.app.state.hf_client.aclose()
+            main.app.state.hf_client = httpx.AsyncClient(
+                base_url="https://hf.test", transport=httpx.MockTransport(handler)
+            )
+            return await coro_fn()
+    return asyncio.run(runner())
+
+
+def echo(inputs):
+    if isinstance(inputs, list):
+        return httpx.Response(200, json=[[{"generated_text": f"re:{p}"}] for p in inputs])
+    return httpx.Response(200, json=[{"generated_text": f"re:{inputs}"}])
+
+
+def test_failed_batch_counts_as_one_breaker_failure():
+    calls = []
+
+    def handler(request):
+        inputs = orjson.loads(request.content)["inputs"]
+        calls.append(inputs)
+        if len(calls) == 1:
+            return httpx.Response(503)
+        return echo(inputs)
+
+    async def go():
+        return await asyncio.gather(*(main.generate(main.Req(prompt=f"p{i}")) for i in range(6)))
+
+    results = run_with_hf(handler, go)
+    assert main.primary_breaker.state == "closed"
+    assert len(calls) >= 2  # the batch was retried, not sent to the fallback
+    assert [r["result"] for r in results] == [f"re:p{i}" for i in range(6)]
+    assert all(r["model"] == main.PRIMARY_REPO for r in results)
+
+
+def test_half_open_admits_a_single_probe():
+    breaker = main.CircuitBreaker("test", threshold=1, cooldown=30)
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    breaker.opened_at = time.monotonic() - 31
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.allow()
+
+
+def test_chat_to_colab_non_json_body_is_502(monkeypatch):
+    monkeypatch.setattr(main, "COLAB_URL", "https://colab.test")
+    monkeypatch.setattr(main, "COLAB_API_KEY", "secret")
+
+    async def go():
+        async with main.lifespan(main.app):
+            await main.app.state.colab_client.aclose()
+            main.app.state.colab_client = httpx.AsyncClient(
+                transport=httpx.MockTransport(lambda request: httpx.Response(200, text="<html>"))
+            )
+            with pytest.raises(main.HTTPException) as exc:
+                await main.chat_to_colab(main.Req(prompt="hi"))
+            return exc.value.status_code
+
+    assert asyncio.run(go()) == 502
+
+
+def test_oversized_prompt_is_rejected_with_413(monkeypatch):
+    monkeypatch.setattr(main, "MAX_INPUT_TOKENS", 10)
+    with pytest.raises(main.HTTPException) as exc:
+        main.check_prompt_size("x" * 100)
+    assert exc.value.status_code == 413
+    main.check_prompt_size("x" * 40)
+
+
+def stream_client(body):
+    main.app.state.hf_client = httpx.AsyncClient(
+        base_url="https://hf.test",
+        transport=httpx.MockTransport(
+            lambda request: httpx.Response(200, content=body, headers={"content-type": "text/event-stream"})
+        ),
+    )
+
+
+def token_line(text):
+    return b"data:" + orjson.dumps({"token": {"text": text, "special": False}}) + b"\n\n"
+
+
+def read_stream(body):
+    async def go():
+        async with main.lifespan(main.app):
+            await main.app.state.hf_client.aclose()
+            stream_client(body)
+            response = await main.generate_stream(main.Req(prompt="hi"))
+            return "".join([chunk async for chunk in response.body_iterator])
+    return asyncio.run(go())
+
+
+def test_stream_stops_at_done_terminator():
+    text = read_stream(token_line("Hel") + token_line("lo") + b"data: [DONE]\n\n")
+    assert 'data: {"token":"Hel"}' in text
+    assert 'data: {"token":"lo"}' in text
+    assert text.endswith(f'event: done\ndata: {{"model":"{main.PRIMARY_REPO}"}}\n\n')
+
+
+def test_stream_reports_malformed_line_as_error_event():
+    text = read_stream(token_line("Hel") + b"data: not-json\n\n")
+    assert "event: error" in text
+    assert "event: done" not in text
+
+
+def test_unexpected_dispatch_error_resolves_every_waiter(monkeypatch):
+    async def broken_post(*args, **kwargs):
+        raise RuntimeError("Cannot send a request, as the client has been closed.")
+
+    monkeypatch.setattr(main, "hf_post", broken_post)
+
+    async def go():
+        async with main.lifespan(main.app):
+            return await asyncio.wait_for(
+                asyncio.gather(
+                    *(main.primary_batcher.submit(f"p{i}", main.PRIMARY_OPTIONS) for i in range(3)),
+                    return_exceptions=True,
+                ),
+                timeout=5,
+            )
+
+    results = asyncio.run(go())
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_single_item_mode_skips_batch_window(monkeypatch):
+    monkeypatch.setattr(main.primary_batcher, "single_mode", True)
+    monkeypatch.setattr(main.primary_batcher, "window", 1.0)
+
+    async def go():
+        start = time.monotonic()
+        await main.primary_batcher.submit("hi", main.PRIMARY_OPTIONS)
+        return time.monotonic() - start
+
+    elapsed = run_with_hf(lambda request: echo(orjson.loads(request.content)["inputs"]), go)
+    assert elapsed < 0.5
+
+
+def test_rejected_prompt_does_not_disable_batching():
+    def handler(request):
+        inputs = orjson.loads(request.content)["inputs"]
+        if isinstance(inputs, list) or inputs == "too long":
+            return httpx.Response(400, json={"error": "input too long"})
+        return echo(inputs)
+
+    async def go():
+        return await asyncio.gather(
+            *(main.primary_batcher.submit(p, main.PRIMARY_OPTIONS) for p in ("ok", "too long"))
+        )
+
+    results = run_with_hf(handler, go)
+    assert [status for status, _ in results] == [200, 400]
+    assert main.primary_batcher.single_mode is False
+
+
+def test_list_rejection_switches_to_single_item_mode():
+    def handler(request):
+        inputs = orjson.loads(request.content)["inputs"]
+        if isinstance(inputs, list):
+            return httpx.Response(400, json={"error": "list input not supported"})
+        return echo(inputs)
+
+    async def go():
+        return await asyncio.gather(
+            *(main.primary_batcher.submit(f"p{i}", main.PRIMARY_OPTIONS) for i in range(3))
+        )
+
+    results = run_with_hf(handler, go)
+    assert [status for status, _ in results] == [200, 200, 200]
+    assert main.primary_batcher.single_mode is True
+
+
+def test_cache_write_failure_keeps_primary_answer(monkeypatch):
+    calls = []
+
+    async def broken_put(*args, **kwargs):
+        raise RuntimeError("embedder failed")
+
+    monkeypatch.setattr(main.response_cache, "put", broken_put)
+
+    def handler(request):
+        inputs = orjson.loads(request.content)["inputs"]
+        calls.append(inputs)
+        return echo(inputs)
+
+    result = run_with_hf(handler, lambda: main.generate(main.Req(prompt="hi")))
+    assert result == {"result": "re:hi", "model": main.PRIMARY_REPO}
+    assert calls == ["hi"]
+
+
+class FakeVector:
+    def __init__(self, value):
+        self.value = value
+
+    def __matmul__(self, other):
+        return 1.0 if self.value == other.value else 0.0
+
+
+class FakeEmbedder:
+    def __init__(self):
+        self.calls = 0
+
+    def encode(self, prompt, normalize_embeddings=True):
+        self.calls += 1
+        return FakeVector(prompt.lower().rstrip("?!"))
+
+
+def test_semantic_hit_reuses_embedding_and_expires_with_ttl():
+    cache = main.ResponseCache("enabled", maxsize=10, ttl=60, semantic_size=10, threshold=0.95)
+    embedder = FakeEmbedder()
+    cache._embedder = embedder
+
+    async def go():
+        hit, vec = await cache.get("k1", "scope", "Hello?")
+        assert hit is None
+        await cache.put("k1", "scope", "Hello?", {"result": "hi"}, vec)
+        assert embedder.calls == 1  # put reused the vector from get
+        similar, _ = await cache.get("k2", "scope", "hello")
+        scope, emb, value, _ = cache._semantic[0]
+        cache._semantic[0] = (scope, emb, value, time.monotonic() - 1)  # past CACHE_TTL
+        expired, _ = await cache.get("k2", "scope", "hello")
+        return similar, expired
+
+    similar, expired = asyncio.run(go())
+    assert similar == {"result": "hi"}
+    assert expired is None
+
+
+def test_estimate_tokens_reads_nested_max_new_tokens():
+    assert main.estimate_tokens({"inputs": "x" * 40, **main.PRIMARY_OPTIONS}) == 10 + main.HF_EST_NEW_TOKENS
+    payload = {"inputs": ["x" * 40, "y" * 8], "parameters": {"max_new_tokens": 5}}
+    assert main.estimate_tokens(payload) == (10 + 5) + (2 + 5)
+
+
+def test_replay_mode_serves_cache_and_404s_on_miss(monkeypatch):
+    cache = main.ResponseCache("replay", maxsize=10, ttl=60, semantic_size=0, threshold=0.95)
+    cache._exact[main.cache_key(main.PRIMARY_REPO, main.PRIMARY_OPTIONS, "known")] = {"result": "old"}
+    monkeypatch.setattr(main, "response_cache", cache)
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return echo(orjson.loads(request.content)["inputs"])
+
+    async def go():
+        hit = await main.generate(main.Req(prompt="known"))
+        with pytest.raises(main.HTTPException) as exc:
+            await main.generate(main.Req(prompt="unknown"))
+        return hit, exc.value.status_code
+
+    hit, status = run_with_hf(handler, go)
+    assert hit == {"result": "old", "cached": True}
+    assert status == 404
+    assert calls == []
+
+
+def test_read_only_mode_never_writes(monkeypatch):
+    cache = main.ResponseCache("read-only", maxsize=10, ttl=60, semantic_size=0, threshold=0.95)
+    monkeypatch.setattr(main, "response_cache", cache)
+    calls = []
+
+    def handler(request):
+        inputs = orjson.loads(request.content)["inputs"]
+        calls.append(inputs)
+        return echo(inputs)
+
+    async def go():
+        first = await main.generate(main.Req(prompt="hi"))
+        second = await main.generate(main.Req(prompt="hi"))
+        return first, second
+
+    first, second = run_with_hf(handler, go)
+    assert first == second == {"result": "re:hi", "model": main.PRIMARY_REPO}
+    assert calls == ["hi", "hi"]
+    assert len(cache._exact) == 0
+
+
+def test_identical_concurrent_prompts_share_one_upstream_call():
+    calls = []
+
+    def handler(request):
+        inputs = orjson.loads(request.content)["inputs"]
+        calls.append(inputs)
+        return echo(inputs)
+
+    async def go():
+        results = await asyncio.gather(*(main.generate(main.Req(prompt="same")) for _ in range(5)))
+        return results, dict(main.in_flight)
+
+    results, left = run_with_hf(handler, go)
+    assert calls == ["same"]  # one request with one input, not a batch of five
+    assert all(r == {"result": "re:same", "model": main.PRIMARY_REPO} for r in results)
+    assert left == {}
+
+
+def test_token_bucket_waits_when_short_and_clamps_oversized_requests():
+    bucket = main.TokenBucket(rpm=0, tpm=6000)  # refills 100 tokens/s
+
+    async def timed(tokens):
+        start = time.monotonic()
+        await bucket.acquire(tokens)
+        return time.monotonic() - start
+
+    async def go():
+        oversized = await timed(10**6)  # clamped to the whole bucket instead of waiting forever
+        short = await timed(10)  # bucket is empty: ~0.1s until 10 tokens refill
+        return oversized, short
+
+    oversized, short = asyncio.run(go())
+    assert oversized < 0.05
+    assert 0.08 <= short < 1
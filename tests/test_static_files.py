@@ -0,0 +1,62 @@
+import gzip
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import main
+from main import PrecompressedStaticFiles
+
+
+def make_client(tmp_path):
+    (tmp_path / "style.css").write_text("body { color: red; }\n" * 50)
+    (tmp_path / "style.css.gz").write_bytes(gzip.compress((tmp_path / "style.css").read_bytes()))
+    app = FastAPI()
+    app.mount("/static", PrecompressedStaticFiles(directory=str(tmp_path)), name="static")
+    return TestClient(app)
+
+
+def test_serves_precompressed_sibling(tmp_path):
+    client = make_client(tmp_path)
+    r = client.get("/static/style.css", headers={"Accept-Encoding": "gzip"})
+    assert r.status_code == 200
+    assert r.headers["content-encoding"] == "gzip"
+    assert r.headers["content-type"].startswith("text/css")
+    assert r.text == "body { color: red; }\n" * 50
+
+
+def test_if_none_match_on_precompressed_asset(tmp_path):
+    client = make_client(tmp_path)
+    first = client.get("/static/style.css", headers={"Accept-Encoding": "gzip"})
+    r = client.get(
+        "/static/style.css",
+        headers={"Accept-Encoding": "gzip", "If-None-Match": first.headers["etag"]},
+    )
+    assert r.status_code == 304
+
+
+def test_if_modified_since_on_precompressed_asset(tmp_path):
+    client = make_client(tmp_path)
+    first = client.get("/static/style.css", headers={"Accept-Encoding": "gzip"})
+    r = client.get(
+        "/static/style.css",
+        headers={"Accept-Encoding": "gzip", "If-Modified-Since": first.headers["last-modified"]},
+    )
+    assert r.status_code == 304
+
+
+def test_static_url_rewrites_index_assets(monkeypatch):
+    monkeypatch.setattr(main, "STATIC_URL", "https://cdn.test/static")
+    html = main._load_index()
+    assert b'"/static/' not in html
+    assert b'<meta name="static-url" content="https://cdn.test/static/" />' in html
+    assert b'href="https://cdn.test/static/css/style.css"' in html
+
+
+def test_home_serves_cached_index_and_304():
+    client = TestClient(main.app)
+    r = client.get("/")
+    assert r.status_code == 200
+    assert r.content == main.INDEX_BYTES
+    r = client.get("/", headers={"If-None-Match": r.headers["etag"]})
+    assert r.status_code == 304
+    assert r.content == b""